@@ -1,63 +1,329 @@
+import io
+import os
 import csv
-import time
+import asyncio
+import hashlib
 import re
 from typing import List
-from langchain_ollama import ChatOllama
-from langchain_core.prompts import ChatPromptTemplate
 
 class AIFixer:
+    # One alternation compiled once: <think> blocks, markdown fences,
+    # "Final Answer:" prefixes and LaTeX \boxed{...} all drop in a single
+    # scan instead of six .replace/.sub passes over the response.
+    # A <think> block truncated by the token cap never gets its closing tag,
+    # so the alternation also accepts end-of-string as the terminator.
+    _CLEANUP_RE = re.compile(
+        r'<think>.*?(?:</think>|\Z)|```csv|```|Final Answer:\s*|\\boxed\{|\}',
+        re.DOTALL | re.IGNORECASE
+    )
+    # "1: a,b,c" / "1. a,b,c" / "1) a,b,c" lines in chunked replies.
+    # The index is captured so callers can verify the sequence, and a '.'
+    # separator must be followed by whitespace so a data line starting with
+    # a decimal ("1.5,foo,bar") is not mistaken for numbering.
+    _NUMBERED_LINE_RE = re.compile(r'\s*(\d+)\s*(?:[:)]|\.(?=\s))\s*(.*\S)')
+
     def __init__(self, model_name: str = "phi4-mini-reasoning:3.8b"):
         self.model_name = model_name
-        self.llm = ChatOllama(model=model_name, temperature=0.1)
-        
-    def fix_ragged_row(self, header: List[str], bad_row_str: str) -> str:
+        # Talk to Ollama's /api/generate directly: single-turn CSV repair
+        # needs none of LangChain's chain/message/callback machinery, and
+        # skipping it saves per-call overhead across hundreds of rows.
+        self.host = os.getenv("OLLAMA_HOST", "http://localhost:11434")
+        self.temperature = 0.1
+        # keep_alive pins the model in Ollama's memory between calls, so a
+        # long-lived AIFixer never pays the model re-load cost
+        self.keep_alive = "10m"
+        # Cap tokens generated per row: an uncapped reasoning model can emit
+        # thousands of <think> tokens for a ~50-token answer, multiplying
+        # tail latency. The cap bounds worst-case close to the typical case.
+        self.num_predict = int(os.getenv("AI_FIXER_NUM_PREDICT", "256"))
+        # Bound how many requests we fire at Ollama at once; the server
+        # interleaves them so wall-clock drops well below N * per-row latency.
+        self.concurrency = int(os.getenv("AI_FIXER_CONCURRENCY", "8"))
+        # How many rows we pack into one prompt so the instruction+header
+        # prefill cost is amortized across rows instead of paid per row.
+        self.chunk_size = int(os.getenv("AI_FIXER_CHUNK", "12"))
+        # Headers whose static prompt prefix we already pushed through Ollama,
+        # so its prompt cache holds the KV states for the shared prefix.
+        self._prefix_warmed = {}
+        # On-disk answer cache so re-running the same file costs zero LLM calls
+        self.cache_dir = os.path.join("data", ".cache", "ai_fixer")
+
+    def _make_client(self):
+        # One client per batch: connections are reused across every request
+        # in the batch, and nothing leaks across asyncio.run event loops.
+        # httpx is imported lazily to keep Streamlit cold start lean.
+        import httpx
+        return httpx.AsyncClient(base_url=self.host, timeout=120)
+
+    async def _generate(self, client, system: str, prompt: str,
+                        num_predict: int = None, stop: List[str] = None) -> str:
+        options = {"temperature": self.temperature}
+        if num_predict is not None:
+            options["num_predict"] = num_predict
+        if stop:
+            options["stop"] = stop
+
+        response = await client.post("/api/generate", json={
+            "model": self.model_name,
+            "system": system,
+            "prompt": prompt,
+            "stream": False,
+            "keep_alive": self.keep_alive,
+            "options": options
+        })
+        response.raise_for_status()
+        return response.json()["response"]
+
+    def _cache_path(self, header: List[str], row: str) -> str:
+        digest = hashlib.blake2b(
+            "\x1f".join([self.model_name, *header, row]).encode("utf-8"),
+            digest_size=16
+        ).hexdigest()
+        return os.path.join(self.cache_dir, digest)
+
+    def _cache_get(self, header: List[str], row: str):
+        try:
+            with open(self._cache_path(header, row), 'r', encoding='utf-8') as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def _cache_put(self, header: List[str], row: str, fixed: str):
+        if fixed.startswith("AI Error:"):
+            return # Never cache failures
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            with open(self._cache_path(header, row), 'w', encoding='utf-8') as f:
+                f.write(fixed)
+        except OSError:
+            pass # Cache is best-effort
+
+    def _system_prefix(self, header: List[str]) -> str:
+        # All static content lives up front so Ollama can reuse the cached
+        # prefix across rows; only the bad row varies per call.
         # Prompt explicitly asks for no markdown, but reasoning models often ignore this
-        prompt = ChatPromptTemplate.from_template("""
+        return f"""
         You are a Data Cleaning Expert.
-        CONTEXT: Header ({num_cols} cols): {header}
-        PROBLEM ROW: {bad_row}
-        
-        TASK: Fix the row to match the header column count. 
+        CONTEXT: Header ({len(header)} cols): {",".join(header)}
+
+        TASK: Fix the row the user gives you to match the header column count.
         - Merge split text fields (e.g. "NY, USA" -> "NY USA").
         - Fill missing fields with 'N/A'.
         - RETURN ONLY THE CSV ROW. DO NOT EXPLAIN.
-        """)
-        
-        chain = prompt | self.llm
-        
+        """
+
+    async def _warm_prefix(self, client, header: List[str]):
+        """
+        Issues one throwaway call so Ollama prefills (and caches) the static
+        prompt prefix before we fan out the real per-row requests.
+        """
+        key = hash(tuple(header))
+        if key in self._prefix_warmed:
+            return
         try:
-            time.sleep(0.1) 
-            
-            response = chain.invoke({
-                "header": ",".join(header),
-                "num_cols": len(header),
-                "bad_row": bad_row_str
+            await client.post("/api/generate", json={
+                "model": self.model_name,
+                "system": self._system_prefix(header),
+                "prompt": "",
+                "stream": False,
+                "keep_alive": self.keep_alive,
+                "options": {"temperature": self.temperature, "num_predict": 1}
             })
-            
-            raw_content = response.content
-            
-            # --- CLEANING LOGIC ---
-            # 1. Remove the <think>...</think> block
-            clean_content = re.sub(r'<think>.*?</think>', '', raw_content, flags=re.DOTALL)
-            
-            # 2. Remove Markdown code blocks (```csv ... ```)
-            clean_content = clean_content.replace("```csv", "").replace("```", "")
-            
-            # 3. Remove "Final Answer:" prefixes if the model adds them
-            clean_content = re.sub(r'Final Answer:\s*', '', clean_content, flags=re.IGNORECASE)
-            
-            # 4. Remove LaTeX boxing \boxed{...} if present
-            clean_content = clean_content.replace(r"\boxed{", "").replace("}", "")
-
-            # 5. Get the last non-empty line (usually the actual data)
-            lines = [line.strip() for line in clean_content.split('\n') if line.strip()]
-            
-            if not lines:
-                return bad_row_str # Fallback if empty
-                
-            final_row = lines[-1] # Take the last line as the result
-            
-            return final_row
-            
+            self._prefix_warmed[key] = True
+        except Exception:
+            # Warm-up is best-effort; the real calls will just pay prefill once
+            pass
+
+    def try_rule_based_fix(self, header: List[str], bad_row_str: str):
+        """
+        Cheap deterministic repair for the common off-by-one cases, so only
+        the genuinely ambiguous rows pay the per-call LLM cost. Returns the
+        fixed CSV row, or None when the row needs the model's judgement.
+        """
+        try:
+            fields = next(csv.reader([bad_row_str]))
+        except (csv.Error, StopIteration):
+            return None
+
+        n_cols = len(header)
+        if len(fields) == n_cols - 1:
+            # One short: the last field was simply missing
+            fields.append("N/A")
+        elif len(fields) == n_cols + 1:
+            # One long: a single unquoted comma split a text field. Only merge
+            # when exactly one adjacent pair is non-numeric text ("NY", " USA");
+            # anything less clear-cut goes to the model.
+            candidates = [
+                i for i in range(len(fields) - 1)
+                if fields[i] and fields[i + 1]
+                and not fields[i].strip().replace('.', '', 1).isdigit()
+                and not fields[i + 1].strip().replace('.', '', 1).isdigit()
+            ]
+            if len(candidates) != 1:
+                return None
+            i = candidates[0]
+            fields[i] = f"{fields[i].rstrip()} {fields[i + 1].lstrip()}"
+            del fields[i + 1]
+        else:
+            return None
+
+        buffer = io.StringIO()
+        csv.writer(buffer, lineterminator='').writerow(fields)
+        return buffer.getvalue()
+
+    def _scrub_markup(self, raw_content: str) -> str:
+        return self._CLEANUP_RE.sub('', raw_content)
+
+    def _clean_response(self, raw_content: str, fallback: str) -> str:
+        clean_content = self._scrub_markup(raw_content)
+
+        # Get the last non-empty line (usually the actual data)
+        lines = [line.strip() for line in clean_content.split('\n') if line.strip()]
+
+        if not lines:
+            return fallback # Fallback if empty
+
+        return lines[-1] # Take the last line as the result
+
+    async def fix_ragged_row_async(self, header: List[str], bad_row_str: str, client=None) -> str:
+        if client is None:
+            async with self._make_client() as own_client:
+                return await self.fix_ragged_row_async(header, bad_row_str, own_client)
+
+        # No "\n\n" stop here: the reasoning trace routinely contains blank
+        # lines, and cutting it mid-<think> would leave reasoning text as the
+        # "answer". num_predict still bounds the worst case.
+        raw_content = await self._generate(
+            client, self._system_prefix(header), bad_row_str,
+            num_predict=self.num_predict, stop=["```"]
+        )
+        return self._clean_response(raw_content, fallback=bad_row_str)
+
+    def fix_ragged_row(self, header: List[str], bad_row_str: str) -> str:
+        """Synchronous single-row entry point (kept for callers outside batch_fix)."""
+        try:
+            return asyncio.run(self.fix_ragged_row_async(header, bad_row_str))
         except Exception as e:
-            return f"AI Error: {str(e)}"
\ No newline at end of file
+            return f"AI Error: {str(e)}"
+
+    def _chunk_system_prefix(self, header: List[str]) -> str:
+        return f"""
+        You are a Data Cleaning Expert.
+        CONTEXT: Header ({len(header)} cols): {",".join(header)}
+
+        TASK: Fix EACH numbered row the user gives you to match the header column count.
+        - Merge split text fields (e.g. "NY, USA" -> "NY USA").
+        - Fill missing fields with 'N/A'.
+        - Return one line per input row, numbered to match (e.g. "1: a,b,c").
+        - RETURN ONLY THE NUMBERED CSV ROWS. DO NOT EXPLAIN.
+        """
+
+    async def _fix_chunk_async(self, client, header: List[str], rows: List[str]):
+        """
+        Fixes a whole chunk of rows in ONE prompt so the prefix prefill cost
+        is shared. Returns None when the reply can't be matched back to the
+        input rows (caller then retries row-by-row).
+        """
+        numbered = "\n".join(f"{i}: {row}" for i, row in enumerate(rows, start=1))
+        prompt = f"ROWS:\n{numbered}\n\nReturn exactly {len(rows)} numbered lines."
+
+        # Numbered lines are single-newline separated, so "\n\n" is not a
+        # safe stop here; the per-row token cap scales with the chunk size
+        raw_content = await self._generate(
+            client, self._chunk_system_prefix(header), prompt,
+            num_predict=self.num_predict * len(rows), stop=["```"]
+        )
+
+        numbers = []
+        fixed = []
+        for line in self._scrub_markup(raw_content).split('\n'):
+            match = self._NUMBERED_LINE_RE.match(line)
+            if match:
+                numbers.append(int(match.group(1)))
+                fixed.append(match.group(2).strip())
+
+        if numbers != list(range(1, len(rows) + 1)):
+            return None # Numbering is off; don't guess at the pairing
+        return fixed
+
+    async def _batch_fix_async(self, header: List[str], bad_rows: List[str], progress_cb=None) -> List[str]:
+        sem = asyncio.Semaphore(self.concurrency)
+        done_count = 0
+
+        async with self._make_client() as client:
+            await self._warm_prefix(client, header)
+
+            async def fix_single(row: str) -> str:
+                async with sem:
+                    try:
+                        return await self.fix_ragged_row_async(header, row, client)
+                    except Exception as e:
+                        # Keep the "AI Error: ..." convention so the UI can skip failed rows
+                        return f"AI Error: {str(e)}"
+
+            async def fix_chunk(rows: List[str]) -> List[str]:
+                async with sem:
+                    try:
+                        fixed = await self._fix_chunk_async(client, header, rows)
+                        if fixed is not None:
+                            return fixed
+                    except Exception:
+                        pass
+                # Chunk reply was unusable: fall back to one call per row
+                return list(await asyncio.gather(*(fix_single(row) for row in rows)))
+
+            async def run_chunk(rows: List[str]) -> List[str]:
+                nonlocal done_count
+                fixed = await fix_chunk(rows)
+                done_count += len(rows)
+                if progress_cb is not None:
+                    progress_cb(done_count, len(bad_rows))
+                return fixed
+
+            chunks = [
+                bad_rows[i:i + self.chunk_size]
+                for i in range(0, len(bad_rows), self.chunk_size)
+            ]
+            chunk_results = await asyncio.gather(*(run_chunk(chunk) for chunk in chunks))
+
+        return [fixed for chunk in chunk_results for fixed in chunk]
+
+    def batch_fix(self, header: List[str], bad_rows: List[str], progress_cb=None) -> List[str]:
+        """
+        Fixes a batch of ragged rows by dispatching concurrent Ollama calls.
+        Rows that deterministic heuristics can repair never reach the model,
+        duplicate rows are fixed once and fanned back out, and answers are
+        cached on disk so reruns of the same file are instant.
+        `progress_cb(done, total)` fires as each chunk of distinct rows
+        completes. Results come back in the same order as `bad_rows`.
+        """
+        if not bad_rows:
+            return []
+
+        # Dedup (preserving first-seen order) and consult the disk cache.
+        # The set gives O(1) membership; the list keeps dispatch order.
+        resolved = {}
+        pending = []
+        pending_seen = set()
+        for row in bad_rows:
+            key = row.strip()
+            if key in resolved or key in pending_seen:
+                continue
+            cached = self._cache_get(header, key)
+            if cached is not None:
+                resolved[key] = cached
+                continue
+            rule_fixed = self.try_rule_based_fix(header, key)
+            if rule_fixed is not None:
+                resolved[key] = rule_fixed
+            else:
+                pending.append(key)
+                pending_seen.add(key)
+
+        if pending:
+            fixed_rows = asyncio.run(self._batch_fix_async(header, pending, progress_cb))
+            for row, fixed in zip(pending, fixed_rows):
+                resolved[row] = fixed
+                self._cache_put(header, row, fixed)
+
+        return [resolved[row.strip()] for row in bad_rows]
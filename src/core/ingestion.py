@@ -1,90 +1,490 @@
+import io
 import os
 import csv
-import polars as pl
-import charset_normalizer
-from pathlib import Path
+import mmap
+import shutil
+from concurrent.futures import ProcessPoolExecutor
 from typing import Tuple, Dict
 
+# Below this size the fork/boundary-scan overhead outweighs the speedup
+_PARALLEL_MIN_BYTES = 64 * 1024 * 1024
+
+
+def _split_chunk_worker(input_path: str, start: int, end: int, sep_count: int,
+                        clean_shard: str, bad_shard: str) -> Tuple[int, int, int]:
+    """
+    Splits one byte range of the input (aligned to line boundaries by the
+    caller) into its own good/bad shard files. Module-level so it can be
+    pickled into a ProcessPoolExecutor worker.
+    The caller guarantees the file contains no quote characters (quoted
+    fields can span lines, which byte-range chunking would tear apart), so
+    the slow path here only ever handles wrong comma counts.
+    """
+    total_rows = 0
+    good_rows = 0
+    bad_rows = 0
+
+    slow_buf = io.StringIO()
+    slow_writer = csv.writer(slow_buf)
+
+    with open(input_path, 'rb') as infile, \
+         open(clean_shard, 'wb') as clean_file, \
+         open(bad_shard, 'wb') as bad_file:
+
+        infile.seek(start)
+        remaining = end - start
+        while remaining > 0:
+            line = infile.readline()
+            if not line:
+                break
+            remaining -= len(line)
+            total_rows += 1
+
+            if b'"' not in line and line.count(b',') == sep_count:
+                clean_file.write(line)
+                good_rows += 1
+                continue
+
+            parsed = list(csv.reader([line.decode('utf-8', errors='replace')]))
+            row = parsed[0] if parsed else []
+
+            slow_buf.seek(0)
+            slow_buf.truncate()
+            slow_writer.writerow(row)
+            encoded = slow_buf.getvalue().encode('utf-8')
+
+            if len(row) == sep_count + 1:
+                clean_file.write(encoded)
+                good_rows += 1
+            else:
+                bad_file.write(encoded)
+                bad_rows += 1
+
+    return total_rows, good_rows, bad_rows
+
 class IngestionEngine:
     """
-    Handles file validation, encoding detection, and the "Stream Split" 
+    Handles file validation, encoding detection, and the "Stream Split"
     strategy to separate good data from bad data.
     """
 
+    @staticmethod
+    def _contains_quote(file_path: str, chunk_size: int = 1 << 20) -> bool:
+        """
+        Whole-file scan for a quote character. Raw comma counting and
+        byte-range chunking are only safe on quote-free files, and a quote
+        past the first sample window must disqualify them too - so this
+        reads every byte (cheap sequential I/O, C-level substring search).
+        """
+        with open(file_path, 'rb') as f:
+            while chunk := f.read(chunk_size):
+                if b'"' in chunk:
+                    return True
+        return False
+
     def validate_file_access(self, file_path: str) -> Dict[str, bool]:
         """
         Checks if file exists, is readable, and not locked.
+        Also returns the signature bytes and file size so downstream checks
+        (encoding detection) don't have to reopen the file.
+        One open() answers existence, permission, signature and size; the
+        separate exists() stat would double the syscalls on a path that
+        runs on every Streamlit rerun.
         """
-        path = Path(file_path)
-        if not path.exists():
-            return {"valid": False, "error": "File does not exist."}
-        
         # "Touch Test": Try to acquire a read handle
         try:
-            with open(path, 'rb') as f:
+            fd = os.open(file_path, os.O_RDONLY)
+            try:
                 # Read signature bytes while we are here
-                sig = f.read(4) 
+                sig = os.read(fd, 4)
+                size = os.fstat(fd).st_size
+            finally:
+                os.close(fd)
+        except FileNotFoundError:
+            return {"valid": False, "error": "File does not exist."}
         except PermissionError:
             return {"valid": False, "error": "Permission Denied. File might be open in another program."}
         except Exception as e:
             return {"valid": False, "error": f"System Error: {str(e)}"}
-            
-        return {"valid": True, "error": None}
 
-    def detect_encoding(self, file_path: str) -> Dict[str, any]:
+        return {"valid": True, "error": None, "signature": sig, "size": size}
+
+    def detect_encoding(self, file_path: str, signature: bytes = None, size: int = None, sample_size: int = 65_536) -> Dict[str, any]:
         """
-        Uses charset-normalizer on the first 50KB.
+        Sniffs the encoding from a sample of at most `sample_size` bytes, so
+        detection cost never scales with file size.
+        BOMs and valid UTF-8 short-circuit immediately; the (much slower)
+        charset-normalizer pass only runs for non-UTF-8 leftovers.
+        `signature`/`size` from validate_file_access let us answer the BOM
+        case without reopening the file, and size-cap the sample read.
         Returns encoding and confidence.
         """
         try:
+            # BOM can be answered from the bytes validate_file_access already read
+            if signature:
+                if signature[:3] == b'\xef\xbb\xbf':
+                    return {"encoding": "utf-8-sig", "confidence": 1.0}
+                if signature[:2] in (b'\xff\xfe', b'\xfe\xff'):
+                    return {"encoding": "utf-16", "confidence": 1.0}
+
+            read_cap = sample_size if size is None else min(size, sample_size)
+
             with open(file_path, 'rb') as f:
-                raw_data = f.read(50_000) # Read first 50KB
-                result = charset_normalizer.detect(raw_data)
-                
-            return {
-                "encoding": result['encoding'] or 'utf-8',
-                "confidence": result['confidence'] or 0.0
-            }
+                raw_data = f.read(read_cap)
+
+            # Tail decode errors are only excusable when the sample window
+            # actually cut the file short; on a full read they are real
+            sample_truncated = (
+                size > read_cap if size is not None else len(raw_data) == read_cap
+            )
+
+            # BOM fast paths
+            if raw_data[:3] == b'\xef\xbb\xbf':
+                return {"encoding": "utf-8-sig", "confidence": 1.0}
+            if raw_data[:2] in (b'\xff\xfe', b'\xfe\xff'):
+                return {"encoding": "utf-16", "confidence": 1.0}
+
+            # Pure ASCII answers itself: bytes.isascii() is a single C-level
+            # scan, cheaper than a full UTF-8 decode of the sample
+            if raw_data.isascii():
+                return {"encoding": "ascii", "confidence": 1.0}
+
+            # The dominant real-world case: plain UTF-8
+            try:
+                raw_data.decode('utf-8')
+                return {"encoding": "utf-8", "confidence": 1.0}
+            except UnicodeDecodeError as e:
+                # The sample window may cut a multi-byte character in half;
+                # an error only at the tail of a truncated read is still
+                # valid UTF-8 - on a full read, fall through to the detectors
+                if sample_truncated and e.start >= len(raw_data) - 4:
+                    return {"encoding": "utf-8", "confidence": 1.0}
+
+            def _validated(enc: str, confidence: float) -> Dict[str, any]:
+                # Detector confidence on short samples is unreliable, so prove
+                # the answer by decoding the sample before reporting it; a bad
+                # guess here means a full re-run of the split downstream.
+                for candidate, conf in ((enc, confidence), ('utf-8', 0.5), ('latin-1', 0.5)):
+                    try:
+                        raw_data.decode(candidate)
+                        return {"encoding": candidate, "confidence": conf}
+                    except UnicodeDecodeError as err:
+                        # Tolerate a tail error only when the sample window
+                        # genuinely cut a multi-byte char in half
+                        if sample_truncated and err.start >= len(raw_data) - 4:
+                            return {"encoding": candidate, "confidence": conf}
+                    except LookupError:
+                        continue
+                # Unreachable in practice: latin-1 decodes any byte sequence
+                return {"encoding": "latin-1", "confidence": 0.5}
+
+            # Rare case: genuinely not UTF-8. Prefer cchardet when installed
+            # (faust-cchardet, compiled C++ — several times faster on real
+            # CSVs); detectors are imported lazily since the dominant UTF-8
+            # case never reaches this point.
+            try:
+                import cchardet
+            except ImportError:
+                cchardet = None
+
+            if cchardet is not None:
+                result = cchardet.detect(raw_data)
+                if result.get("encoding"):
+                    return _validated(result["encoding"], result.get("confidence") or 0.0)
+
+            import charset_normalizer
+            best = charset_normalizer.from_bytes(raw_data, steps=3, chunk_size=2048).best()
+            if best is None:
+                return {"encoding": "utf-8", "confidence": 0.0}
+
+            return _validated(best.encoding, 1.0 - best.chaos)
         except Exception as e:
             return {"encoding": "utf-8", "confidence": 0.0, "error": str(e)}
 
-    def stream_clean_and_split(self, input_path: str, clean_out_path: str, quarantine_out_path: str, encoding: str = 'utf-8') -> Dict[str, int]:
+    def stream_clean_and_split(self, input_path: str, clean_out_path: str, quarantine_out_path: str, encoding: str = 'utf-8', progress_cb=None) -> Dict[str, int]:
         """
         The "Stream Cleaner":
         1. Reads raw file line-by-line.
         2. Infers expected column count from header.
         3. Writes valid rows to `clean_out_path`.
         4. Writes ragged rows to `quarantine_out_path`.
+
+        Well-formed rows (no quotes) are validated by counting commas on the
+        raw bytes and copied through verbatim; only lines containing a quote
+        or a wrong comma count go through csv.reader.
+        `progress_cb(good, bad)` is invoked every 100k rows on the streaming
+        paths so callers can surface live counts.
+        """
+        # Raw byte copying is only safe when the input is already UTF-8
+        # compatible; anything else takes the decoding text-mode path.
+        if encoding.lower().replace('-', '_') not in ('utf_8', 'utf8', 'ascii', 'us_ascii', 'utf_8_sig'):
+            return self._split_text_mode(input_path, clean_out_path, quarantine_out_path, encoding, progress_cb)
+
+        # Dispatch on size: below the threshold the vectorized (but eager)
+        # Polars partition wins; at or above it the chunked process pool
+        # keeps memory bounded. Either may decline (quotes in the file) or
+        # raise - the sequential loop below always works.
+        try:
+            if os.path.getsize(input_path) < _PARALLEL_MIN_BYTES:
+                result = self._split_with_polars(input_path, clean_out_path, quarantine_out_path)
+            else:
+                result = self.parallel_clean_and_split(input_path, clean_out_path, quarantine_out_path)
+            if result is not None:
+                return result
+        except Exception:
+            pass # Both fast paths are opportunistic
+
+        total_rows = 0
+        good_rows = 0
+        bad_rows = 0
+
+        with open(input_path, 'rb') as infile, \
+             open(clean_out_path, 'wb') as clean_file, \
+             open(quarantine_out_path, 'wb') as bad_file:
+
+            # Process Header (csv.reader once, to learn the column count)
+            header_line = infile.readline()
+            if not header_line:
+                return {"status": "empty_file"}
+
+            header_text = header_line.decode('utf-8', errors='replace').lstrip('\ufeff')
+            header = next(csv.reader([header_text]))
+            expected_cols = len(header)
+            sep_count = expected_cols - 1
+
+            clean_file.write(header_line) # Write header to clean file
+            # Write header to quarantine too (so we can load it later)
+            bad_file.write(header_line)
+
+            # Reusable buffer for re-serializing slow-path rows
+            slow_buf = io.StringIO()
+            slow_writer = csv.writer(slow_buf)
+
+            def route_slow(record: bytes):
+                # Let csv.reader resolve quoting/escaping on the full record
+                nonlocal good_rows, bad_rows
+                parsed = list(csv.reader([record.decode('utf-8', errors='replace')]))
+                row = parsed[0] if parsed else []
+
+                slow_buf.seek(0)
+                slow_buf.truncate()
+                slow_writer.writerow(row)
+                encoded = slow_buf.getvalue().encode('utf-8')
+
+                if len(row) == expected_cols:
+                    clean_file.write(encoded)
+                    good_rows += 1
+                else:
+                    # Write the re-serialized row to quarantine
+                    bad_file.write(encoded)
+                    bad_rows += 1
+
+            # A quoted field may legally contain newlines; while a record's
+            # running quote count is odd we are inside such a field, so keep
+            # appending physical lines until the quotes balance.
+            pending = b''
+
+            # Process Data Stream
+            for line in infile:
+                if pending:
+                    line = pending + line
+                    pending = b''
+                if line.count(b'"') % 2 == 1:
+                    pending = line
+                    continue
+
+                total_rows += 1
+                if progress_cb is not None and total_rows % 100_000 == 0:
+                    progress_cb(good_rows, bad_rows)
+
+                # Fast path: no quoting involved, comma count tells us everything
+                if b'"' not in line and line.count(b',') == sep_count:
+                    clean_file.write(line)
+                    good_rows += 1
+                    continue
+
+                route_slow(line)
+
+            if pending:
+                # Unterminated quote at EOF: route what we have as one record
+                total_rows += 1
+                route_slow(pending)
+
+        return {
+            "total": total_rows,
+            "good": good_rows,
+            "bad": bad_rows,
+            "expected_cols": expected_cols
+        }
+
+    def _split_with_polars(self, input_path: str, clean_out_path: str, quarantine_out_path: str):
+        """
+        Vectorized split: loads the file as one text column and partitions on
+        a per-line comma count computed in Polars' native engine. Returns
+        None when the file contains quote characters (a raw comma count
+        cannot see quoting, so those files go through the streaming path).
+        The read is eager, so the caller only dispatches here for files
+        below _PARALLEL_MIN_BYTES.
+        """
+        import polars as pl
+
+        if self._contains_quote(input_path):
+            return None
+
+        # Record Separator (0x1E) should never occur in text, so every line
+        # lands in a single "raw" column; if it does occur, the resulting
+        # ragged read raises and the caller falls back.
+        df = pl.read_csv(
+            input_path,
+            separator="\x1e",
+            quote_char=None,
+            has_header=False,
+            new_columns=["raw"],
+            encoding="utf8-lossy"
+        )
+        if df.height == 0:
+            return {"status": "empty_file"}
+
+        header = df.item(0, "raw")
+        sep_count = header.count(",")
+
+        body = df.slice(1)
+        mask = body.get_column("raw").str.count_matches(",", literal=True) == sep_count
+        good = body.filter(mask)
+        bad = body.filter(~mask)
+
+        # Lines are already fully serialized CSV; never re-quote them
+        header_df = pl.DataFrame({"raw": [header]})
+        pl.concat([header_df, good]).write_csv(clean_out_path, include_header=False, quote_style="never")
+        pl.concat([header_df, bad]).write_csv(quarantine_out_path, include_header=False, quote_style="never")
+
+        return {
+            "total": body.height,
+            "good": good.height,
+            "bad": bad.height,
+            "expected_cols": sep_count + 1
+        }
+
+    def parallel_clean_and_split(self, input_path: str, clean_out_path: str, quarantine_out_path: str, workers: int = None):
+        """
+        Splits the file across a process pool: byte ranges are aligned to
+        line boundaries via mmap, each worker writes its own good/bad shard
+        with the raw-byte fast path, and the shards are concatenated at the
+        end. Returns None when the file isn't safe to chunk (quoted fields
+        could span lines) so the caller can fall back.
+        """
+        # Quoted fields can contain newlines, which chunking would tear apart;
+        # a quote anywhere in the file disqualifies this path
+        if self._contains_quote(input_path):
+            return None
+
+        with open(input_path, 'rb') as f:
+            header_line = f.readline()
+            if not header_line:
+                return {"status": "empty_file"}
+
+            header = next(csv.reader([header_line.decode('utf-8', errors='replace').lstrip('\ufeff')]))
+            expected_cols = len(header)
+            sep_count = expected_cols - 1
+
+            size = os.fstat(f.fileno()).st_size
+            data_start = len(header_line)
+
+            workers = workers or os.cpu_count() or 1
+            chunk = max(1, (size - data_start) // workers)
+
+            # Advance each tentative boundary to the next newline so no
+            # worker ever starts mid-row
+            boundaries = [data_start]
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                for i in range(1, workers):
+                    pos = mm.find(b'\n', data_start + i * chunk)
+                    boundary = size if pos == -1 else pos + 1
+                    if boundary > boundaries[-1]:
+                        boundaries.append(boundary)
+            boundaries.append(size)
+
+        shards = [
+            (f"{clean_out_path}.shard{i}", f"{quarantine_out_path}.shard{i}")
+            for i in range(len(boundaries) - 1)
+        ]
+
+        total_rows = 0
+        good_rows = 0
+        bad_rows = 0
+        try:
+            with ProcessPoolExecutor(max_workers=len(shards)) as pool:
+                futures = [
+                    pool.submit(_split_chunk_worker, input_path,
+                                boundaries[i], boundaries[i + 1], sep_count,
+                                clean_shard, bad_shard)
+                    for i, (clean_shard, bad_shard) in enumerate(shards)
+                ]
+                for future in futures:
+                    total, good, bad = future.result()
+                    total_rows += total
+                    good_rows += good
+                    bad_rows += bad
+
+            # Stitch the shards back together behind the shared header
+            with open(clean_out_path, 'wb') as clean_file, \
+                 open(quarantine_out_path, 'wb') as bad_file:
+                clean_file.write(header_line)
+                bad_file.write(header_line)
+                for clean_shard, bad_shard in shards:
+                    with open(clean_shard, 'rb') as shard:
+                        shutil.copyfileobj(shard, clean_file)
+                    with open(bad_shard, 'rb') as shard:
+                        shutil.copyfileobj(shard, bad_file)
+        finally:
+            for clean_shard, bad_shard in shards:
+                for shard in (clean_shard, bad_shard):
+                    if os.path.exists(shard):
+                        os.unlink(shard)
+
+        return {
+            "total": total_rows,
+            "good": good_rows,
+            "bad": bad_rows,
+            "expected_cols": expected_cols
+        }
+
+    def _split_text_mode(self, input_path: str, clean_out_path: str, quarantine_out_path: str, encoding: str, progress_cb=None) -> Dict[str, int]:
+        """
+        Decoding fallback for non-UTF-8 inputs: every row goes through
+        csv.reader and is re-written as UTF-8.
         """
         total_rows = 0
         good_rows = 0
         bad_rows = 0
         expected_cols = 0
-        
+
         # Python's CSV module is robust for streaming
         with open(input_path, 'r', encoding=encoding, errors='replace') as infile, \
              open(clean_out_path, 'w', encoding='utf-8', newline='') as clean_file, \
              open(quarantine_out_path, 'w', encoding='utf-8', newline='') as bad_file:
-            
+
             # Using csv.reader to handle quoting/escaping logic automatically
             reader = csv.reader(infile)
             clean_writer = csv.writer(clean_file)
             bad_writer = csv.writer(bad_file)
-            
+
             try:
                 # Process Header
                 header = next(reader)
                 expected_cols = len(header)
                 clean_writer.writerow(header) # Write header to clean file
                 # Write header to quarantine too (so we can load it later)
-                bad_writer.writerow(header) 
-                
+                bad_writer.writerow(header)
+
             except StopIteration:
                 return {"status": "empty_file"}
 
             # Process Data Stream
             for row in reader:
                 total_rows += 1
+                if progress_cb is not None and total_rows % 100_000 == 0:
+                    progress_cb(good_rows, bad_rows)
                 if len(row) == expected_cols:
                     clean_writer.writerow(row)
                     good_rows += 1
@@ -92,7 +492,7 @@ class IngestionEngine:
                     # Write the raw row to quarantine
                     bad_writer.writerow(row)
                     bad_rows += 1
-                    
+
         return {
             "total": total_rows,
             "good": good_rows,
@@ -104,10 +504,15 @@ class IngestionEngine:
         """
         Converts the CLEAN csv to Parquet using Polars for high-speed downstream tasks.
         """
+        import polars as pl
+
         try:
-            # We can safely use polars now because the CSV is structurally clean
-            df = pl.scan_csv(csv_path)
-            df.sink_parquet(parquet_path)
+            # We can safely use polars now because the CSV is structurally clean.
+            # The streaming sink writes row groups while parsing, so memory
+            # stays proportional to one batch; 100k-row groups keep head()
+            # previews reading a single group.
+            df = pl.scan_csv(csv_path, infer_schema_length=10_000)
+            df.sink_parquet(parquet_path, compression='zstd', row_group_size=100_000)
             return True
         except Exception as e:
             print(f"Parquet Conversion Failed: {e}")
@@ -120,6 +525,8 @@ class IngestionEngine:
         Merges the original clean data with the user-repaired data 
         and converts everything to the Master Parquet file.
         """
+        import polars as pl
+
         try:
             # 1. Read the Clean Data
             df_clean = pl.scan_csv(clean_csv_path)
@@ -140,8 +547,8 @@ class IngestionEngine:
             else:
                 df_final = df_clean
 
-            # 3. Sink to Parquet
-            df_final.sink_parquet(final_parquet_path)
+            # 3. Sink to Parquet (same streaming options as convert_to_parquet)
+            df_final.sink_parquet(final_parquet_path, compression='zstd', row_group_size=100_000)
             
             # 4. Count rows for confirmation
             final_count = pl.read_parquet(final_parquet_path).height
@@ -1,7 +1,47 @@
 import os
-import shutil
-from datetime import datetime
-from typing import List, Dict, Any
+import time
+import uuid
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Deque, Dict
+
+# Oldest entries roll off so a long session can't grow history unbounded
+_MAX_LOGS_PER_PHASE = 500
+
+
+def _fast_rmtree(path: str):
+    """
+    Flat scandir/unlink delete. shutil.rmtree stats every entry and handles
+    corner cases we don't have in our own cache dirs; for session caches
+    full of small shards this loop is a few times faster.
+    """
+    with os.scandir(path) as it:
+        for entry in it:
+            if entry.is_dir(follow_symlinks=False):
+                _fast_rmtree(entry.path)
+            else:
+                os.unlink(entry.path)
+    os.rmdir(path)
+
+
+@dataclass(slots=True)
+class LogEntry:
+    """One history event. Slots keep this at a fraction of a dict's size."""
+    time: int # epoch seconds; formatted lazily at render time
+    category: str
+    message: str
+
+    @property
+    def clock(self) -> str:
+        """HH:MM:SS without strftime's locale/format-parsing machinery."""
+        lt = time.localtime(self.time)
+        return f"{lt.tm_hour:02d}:{lt.tm_min:02d}:{lt.tm_sec:02d}"
+
+
+@dataclass(slots=True)
+class PhaseLog:
+    status: str
+    logs: Deque[LogEntry] = field(default_factory=lambda: deque(maxlen=_MAX_LOGS_PER_PHASE))
 
 class StateManager:
     """
@@ -10,6 +50,10 @@ class StateManager:
     """
     def __init__(self, session_id: str):
         self.session_id = session_id
+        # session_id is shared ("session_default") and _version restarts at 0
+        # per instance, so global caches keyed on them would collide across
+        # browser sessions; the nonce makes each manager's keys unique
+        self.instance_id = uuid.uuid4().hex
         # Define base paths
         self.base_dir = os.path.join("data", ".cache", session_id)
         self.upload_dir = os.path.join(self.base_dir, "uploads")
@@ -24,11 +68,15 @@ class StateManager:
         self.active_file_path: str = None # Path to current Parquet file
         self.quarantine_path: str = None  # Path to current Bad Rows CSV
         
+        # Bumped on every mutation so callers can cheaply detect "history
+        # unchanged since last look" without comparing the whole tree
+        self._version = 0
+
         # The History Tree structure
-        self.history: Dict[str, Dict[str, Any]] = {
-            "Phase 1: Ingestion": {"status": "active", "logs": []},
-            "Phase 2: Structure": {"status": "pending", "logs": []},
-            "Phase 3: Cleaning": {"status": "pending", "logs": []}
+        self.history: Dict[str, PhaseLog] = {
+            "Phase 1: Ingestion": PhaseLog(status="active"),
+            "Phase 2: Structure": PhaseLog(status="pending"),
+            "Phase 3: Cleaning": PhaseLog(status="pending")
         }
 
     def _init_dirs(self):
@@ -38,14 +86,17 @@ class StateManager:
 
     def log_event(self, phase: str, category: str, message: str):
         """Adds an event to the history tree."""
-        timestamp = datetime.now().strftime("%H:%M:%S")
-        entry = {"time": timestamp, "category": category, "message": message}
-        
-        if phase in self.history:
-            self.history[phase]["logs"].append(entry)
+        phase_log = self.history.get(phase)
+        if phase_log is not None:
+            phase_log.logs.append(LogEntry(time=int(time.time()), category=category, message=message))
             # Auto-update status if needed
-            if self.history[phase]["status"] == "pending":
-                self.history[phase]["status"] = "active"
+            if phase_log.status == "pending":
+                phase_log.status = "active"
+            self._version += 1
+
+    @property
+    def history_version(self) -> int:
+        return self._version
 
     def get_history(self):
         return self.history
@@ -53,5 +104,5 @@ class StateManager:
     def clear_session(self):
         """Cleans up temporary files."""
         if os.path.exists(self.base_dir):
-            shutil.rmtree(self.base_dir)
+            _fast_rmtree(self.base_dir)
             self._init_dirs()
\ No newline at end of file
@@ -1,7 +1,12 @@
+import csv
 import os
+import hashlib
+import queue
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
 import streamlit as st
-import polars as pl
-import pandas as pd
 from src.core.state_manager import StateManager
 from src.core.ingestion import IngestionEngine
 from src.core.ai_fixer import AIFixer
@@ -14,18 +19,69 @@ if "processing_complete" not in st.session_state:
     st.session_state.processing_complete = False
 if "manual_edit_mode" not in st.session_state:
     st.session_state.manual_edit_mode = False
-if "split_stats" not in st.session_state:
-    st.session_state.split_stats = None
 if "ai_preview_data" not in st.session_state:
     st.session_state.ai_preview_data = None 
 
 manager = st.session_state.state_manager
-engine = IngestionEngine()
+
+# Resource-scoped singletons: constructing these per rerun would rebuild the
+# Ollama client state (warm-prefix bookkeeping etc.) on every widget interaction.
+@st.cache_resource
+def get_engine():
+    return IngestionEngine()
+
+@st.cache_resource
+def get_fixer(model_name: str):
+    return AIFixer(model_name=model_name)
+
+@st.cache_resource
+def get_pool():
+    return ThreadPoolExecutor(max_workers=2)
+
+@st.cache_data(show_spinner=False)
+def detect_encoding_cached(file_key: str, path: str, signature: bytes, size: int) -> dict:
+    """Encoding detection keyed by content hash, so identical re-uploads
+    (even after a session reset) are O(1) cache hits."""
+    return engine.detect_encoding(path, signature=signature, size=size, sample_size=65_536)
+
+@st.cache_data(show_spinner=False)
+def history_snapshot(instance_id: str, version: int):
+    """History tree keyed on the manager's instance nonce plus its version
+    counter: reruns that didn't log anything reuse the pickled snapshot, and
+    a fresh session (new manager, version back at 0) can never replay a
+    previous session's entries."""
+    return manager.get_history()
+
+@st.cache_data(show_spinner=False)
+def clean_preview(path: str, mtime: float, n_rows: int = 50):
+    """First rows of the clean CSV; memoized so widget reruns that don't
+    touch the file never re-tokenize it. The lazy scan pushes the row limit
+    into the reader, so only the leading bytes of the file are parsed."""
+    import polars as pl
+    return pl.scan_csv(path).head(n_rows).collect()
+
+@st.cache_data(show_spinner=False)
+def parquet_preview(path: str, mtime: float, n_rows: int = 50):
+    """Lazy scan pushes the row limit into the Parquet reader, so only the
+    first row group is read; the collected frame is memoized per file version."""
+    import polars as pl
+    return pl.scan_parquet(path).head(n_rows).collect()
+
+@st.cache_data(show_spinner=False)
+def quarantine_preview(path: str, mtime: float, n_lines: int = 20) -> str:
+    """First n lines of the quarantine file; never loads the whole thing."""
+    with open(path, 'r', encoding='utf-8') as f:
+        return "".join(islice(f, n_lines))
+
+# Bounds the editor payload pushed over the Streamlit websocket
+MAX_EDIT_ROWS = 500
+
+engine = get_engine()
 
 def main():
     st.set_page_config(page_title="Local AI Data Cleaner", layout="wide")
     render_header()
-    render_history_sidebar(manager.get_history())
+    render_history_sidebar(history_snapshot(manager.instance_id, manager.history_version))
 
     # --- 2. FILE UPLOAD ---
     uploaded_file = st.file_uploader("Upload Data", type=["csv", "xlsx", "txt"])
@@ -33,64 +89,163 @@ def main():
     if not uploaded_file:
         # Reset state if file is removed
         st.session_state.processing_complete = False
-        st.session_state.split_stats = None
         st.session_state.ai_preview_data = None
         return
 
+    # Content signature keys all derived artifacts, so a rerun never re-splits
+    # the same bytes and a *different* upload never reuses stale stats.
+    # Size plus a hash of the first MiB identifies the file without paying a
+    # full-buffer hash on every rerun of a multi-GB upload.
+    head = uploaded_file.getbuffer()[:1 << 20]
+    file_key = f"{uploaded_file.size}-{hashlib.blake2b(head, digest_size=8).hexdigest()}"
+    stats_key = f"split_stats::{file_key}"
+    enc_key = f"encoding::{file_key}"
+
     # Path Setup
     temp_path = os.path.join(manager.upload_dir, uploaded_file.name)
     clean_path = os.path.join(manager.processed_dir, "clean_temp.csv")
     quarantine_path = os.path.join(manager.quarantine_dir, "bad_rows.csv")
     pq_path = os.path.join(manager.processed_dir, "master.parquet")
 
-    # Save File (Only once)
-    if not os.path.exists(temp_path):
+    # Save File (once per content key, not per filename: a modified re-upload
+    # under the same name must overwrite the stale on-disk copy). Streaming in
+    # 1 MiB chunks keeps peak memory at one chunk instead of materializing the
+    # whole upload a second time.
+    saved_marker = f"saved::{temp_path}"
+    if st.session_state.get(saved_marker) != file_key:
+        uploaded_file.seek(0)
         with open(temp_path, "wb") as f:
-            f.write(uploaded_file.getbuffer())
+            shutil.copyfileobj(uploaded_file, f, length=1 << 20)
+        st.session_state[saved_marker] = file_key
         manager.log_event("Phase 1: Ingestion", "Upload", f"File '{uploaded_file.name}' received.")
 
-    # --- 3. ANALYSIS & CHECKS (Run once per file) ---
-    if st.session_state.split_stats is None:
-        with st.spinner("Running System Checks..."):
-            
-            # Check 1: Access
+    # --- 3. ANALYSIS & CHECKS (Run once per file content) ---
+    # Stats are keyed by content, but clean_temp.csv / bad_rows.csv live at
+    # shared paths every split overwrites. Returning to an earlier upload
+    # (A, B, A) finds A's cached stats while B's rows are still on disk, so
+    # the split must also re-run whenever the artifacts belong to another key.
+    artifacts_marker = f"split_output::{clean_path}"
+    if (
+        stats_key not in st.session_state
+        or st.session_state.get(artifacts_marker) != file_key
+    ):
+        # One in-flight split at a time, under fixed keys: swapping the upload
+        # mid-split must not start a second writer on the same output files,
+        # and per-file keys would leave orphaned futures in session_state.
+        stale_future = st.session_state.get("split_future")
+        if stale_future is not None and st.session_state.get("split_future_key") != file_key:
+            if not stale_future.cancel() and not stale_future.done():
+                st.info("⏳ Waiting for the previous file's analysis to finish...")
+                time.sleep(0.5)
+                st.rerun()
+            # The abandoned run is over (or never started); drop its bookkeeping
+            for key in ("split_future", "split_future_key", "split_progress"):
+                st.session_state.pop(key, None)
+
+        if "split_future" not in st.session_state:
+            # Checks 1 & 2 are cheap and stay synchronous
             access = engine.validate_file_access(temp_path)
             if not access["valid"]:
                 st.error(access["error"])
                 return
             manager.log_event("Phase 1: Ingestion", "Access Check", "✅ File permissions verified.")
 
-            # Check 2: Encoding
-            enc_res = engine.detect_encoding(temp_path)
+            # Check 2: Encoding (reuses the signature/size from the access check)
+            enc_res = detect_encoding_cached(
+                file_key,
+                temp_path,
+                access.get("signature"),
+                access.get("size")
+            )
+            st.session_state[enc_key] = enc_res
             encoding = enc_res["encoding"]
             manager.log_event("Phase 1: Ingestion", "Encoding", f"✅ Detected {encoding} ({enc_res['confidence']*100:.0f}%)")
 
-            # Check 3: Structure (Stream Split)
-            stats = engine.stream_clean_and_split(temp_path, clean_path, quarantine_path, encoding)
-            st.session_state.split_stats = stats
-            
-            if stats["bad"] > 0:
-                manager.log_event("Phase 1: Ingestion", "Structure", f"❌ Ragged Rows: {stats['bad']} found.")
-            else:
-                manager.log_event("Phase 1: Ingestion", "Structure", "✅ Structure perfectly aligned.")
+            # Check 3: Structure (Stream Split) — can take minutes on big
+            # files, so it runs on a worker thread while the page stays live
+            progress_q = queue.Queue()
+            st.session_state["split_progress"] = progress_q
+            st.session_state["split_future"] = get_pool().submit(
+                engine.stream_clean_and_split,
+                temp_path, clean_path, quarantine_path, encoding,
+                progress_cb=lambda good, bad: progress_q.put((good, bad))
+            )
+            st.session_state["split_future_key"] = file_key
 
-            # Force re-render to update sidebar immediately
+        future = st.session_state["split_future"]
+        if not future.done():
+            # Drain the queue so we always show the freshest counts
+            latest = None
+            progress_q = st.session_state["split_progress"]
+            while not progress_q.empty():
+                latest = progress_q.get_nowait()
+            if latest:
+                st.info(f"🔍 Splitting... {latest[0]:,} good / {latest[1]:,} bad rows so far.")
+            else:
+                st.info("🔍 Running Structure Check...")
+            time.sleep(0.5)
             st.rerun()
 
+        for key in ("split_future", "split_future_key", "split_progress"):
+            st.session_state.pop(key, None)
+        try:
+            stats = future.result()
+        except Exception as e:
+            # Keep the failure in state so reruns don't resubmit the split
+            stats = {"error": str(e)}
+        st.session_state[stats_key] = stats
+        st.session_state[artifacts_marker] = file_key
+
+        if stats.get("error"):
+            manager.log_event("Phase 1: Ingestion", "Structure", f"❌ Split failed: {stats['error']}")
+        elif stats.get("bad", 0) > 0:
+            manager.log_event("Phase 1: Ingestion", "Structure", f"❌ Ragged Rows: {stats['bad']} found.")
+        else:
+            manager.log_event("Phase 1: Ingestion", "Structure", "✅ Structure perfectly aligned.")
+
+        # Force re-render to update sidebar immediately
+        st.rerun()
+
     # Load Stats from State
-    stats = st.session_state.split_stats
-    
+    stats = st.session_state[stats_key]
+    if stats.get("error"):
+        st.error(f"Structure check failed: {stats['error']}")
+        return
+    detected_encoding = st.session_state.get(enc_key, {}).get("encoding", "utf-8")
+
+    # Read the clean-file header once per upload; every repair branch used to
+    # reopen clean_temp.csv just to re-parse this same first line.
+    # utf-8-sig: the byte-mode splitter copies an upload's BOM into
+    # clean_temp.csv, and a \ufeff prefix on the first column name would leak
+    # into the LLM prompt and the fixed-file headers.
+    header_key = f"header::{file_key}"
+    if header_key not in st.session_state and os.path.exists(clean_path):
+        with open(clean_path, 'r', encoding='utf-8-sig', newline='') as f:
+            st.session_state[header_key] = next(csv.reader(f), [])
+    header_list = st.session_state.get(header_key, [])
+
     # --- 4. DASHBOARD ---
     # Determine Health Label
     health_status = "Healthy" if stats["bad"] == 0 else "Needs Repair"
-    render_status_metrics(True, "UTF-8", health_status)
+    render_status_metrics(True, detected_encoding, health_status)
 
     # --- 5. LOGIC FOR HEALTHY VS BROKEN ---
     if stats["bad"] == 0 or st.session_state.processing_complete:
+        # The healthy path never goes through merge_and_finalize, so build
+        # the master Parquet here from the clean CSV. master.parquet persists
+        # across uploads (and app restarts), so mere existence is not enough:
+        # a Parquet older than the current clean file is a previous upload's
+        # data and must be overwritten. A repair merge writes the Parquet
+        # *after* the split, so its output stays newer and is never clobbered.
+        if os.path.exists(clean_path) and (
+            not os.path.exists(pq_path)
+            or os.path.getmtime(pq_path) < os.path.getmtime(clean_path)
+        ):
+            with st.spinner("Converting to Parquet..."):
+                engine.convert_to_parquet(clean_path, pq_path)
         st.success("✅ File is clean and loaded into Master Parquet.")
         if os.path.exists(pq_path):
-            df = pl.read_parquet(pq_path)
-            st.dataframe(df.head(50), use_container_width=True)
+            st.dataframe(parquet_preview(pq_path, os.path.getmtime(pq_path)), use_container_width=True)
     else:
         st.error(f"⚠️ {stats['bad']} rows failed structure check.")
         
@@ -99,13 +254,12 @@ def main():
         # TAB 1: INSPECTOR
         with tab_view:
             col1, col2 = st.columns(2)
-            with col1: 
+            with col1:
                 st.caption("✅ Good Data Sample")
-                st.dataframe(pl.read_csv(clean_path, n_rows=50), use_container_width=True)
+                st.dataframe(clean_preview(clean_path, os.path.getmtime(clean_path)), use_container_width=True)
             with col2:
                 st.caption("❌ Bad Data (Raw Text)")
-                with open(quarantine_path, "r") as f:
-                    st.text("".join(f.readlines()[:20]))
+                st.text(quarantine_preview(quarantine_path, os.path.getmtime(quarantine_path)))
 
         # TAB 2: REPAIR STATION
         with tab_repair:
@@ -115,9 +269,15 @@ def main():
                 st.markdown("### 🤖 Review AI Proposals")
                 st.info("The AI has analyzed the bad rows. Please review the proposed fixes before applying.")
                 
-                # Create a comparison dataframe for display
+                # Create a comparison dataframe for display. Polars keeps the
+                # strings Arrow-backed, which is what the Streamlit transport
+                # serializes to anyway - one less copy than pandas object columns.
+                import polars as pl
                 preview_list = st.session_state.ai_preview_data
-                df_preview = pd.DataFrame(preview_list)
+                df_preview = pl.DataFrame({
+                    "original": [d["original"] for d in preview_list],
+                    "fixed": [d["fixed"] for d in preview_list],
+                })
                 
                 # Show Editable Dataframe (User can tweak AI's fix if it's slightly off)
                 edited_preview = st.data_editor(
@@ -135,17 +295,23 @@ def main():
                 # ACCEPT BUTTON
                 if col_accept.button("✅ Accept & Apply"):
                     # 1. Save the APPROVED fixes (from edited_preview)
-                    with open(clean_path, 'r') as f: header = f.readline().strip().split(',')
-                    
                     fixed_file = os.path.join(manager.processed_dir, "fixed_ai.csv")
-                    
+
+
+                    # If AI failed on a row, skip it
+                    approved = [
+                        fixed for fixed in edited_preview["fixed"]
+                        if "Error:" not in fixed
+                    ]
+
                     # --- FIX: ADD encoding='utf-8' HERE TO PREVENT CHARMAP ERROR ---
-                    with open(fixed_file, 'w', encoding='utf-8', newline='') as f:
-                        f.write(",".join(header) + "\n")
-                        for index, row in edited_preview.iterrows():
-                            # If AI failed on a row, skip it or write raw
-                            if "Error:" in row['fixed']: continue
-                            f.write(row['fixed'] + "\n")
+                    # csv.writer re-quotes in one C-accelerated pass instead of a
+                    # Python-level write per row; the 1 MiB buffer batches the
+                    # underlying write() syscalls
+                    with open(fixed_file, 'w', encoding='utf-8', newline='', buffering=1 << 20) as f:
+                        writer = csv.writer(f)
+                        writer.writerow(header_list)
+                        writer.writerows(csv.reader(approved))
                     
                     # 2. Merge
                     res = engine.merge_and_finalize(clean_path, fixed_file, pq_path)
@@ -175,38 +341,47 @@ def main():
 
                 # --- STRATEGY B: AI FIX ---
                 if c1.button("🤖 AI Auto-Fix", use_container_width=True):
-                    # Use the specific model name
-                    fixer = AIFixer(model_name="phi4-mini-reasoning:3.8b")
+                    # Use the specific model name (cached across clicks/reruns)
+                    fixer = get_fixer("phi4-mini-reasoning:3.8b")
                     
                     with st.status("AI Agent analyzing rows...", expanded=True) as status:
-                        # Read Header
-                        with open(clean_path, 'r') as f: header_list = f.readline().strip().split(',')
                         header_str = ",".join(header_list).strip()
                         
-                        # Read Bad Rows
-                        with open(quarantine_path, 'r') as f: bad_rows = f.readlines()
-                        
-                        preview_data = []
-                        for i, row in enumerate(bad_rows):
-                            clean_row = row.strip()
-                            if not clean_row: continue
-                            
-                            # --- CRITICAL FIX: SKIP HEADER IF PRESENT IN BAD ROWS ---
-                            if clean_row == header_str:
-                                continue
-                            # --------------------------------------------------------
-
-                            status.update(label=f"Reasoning on row {i+1}...")
-                            
-                            # Get fix
-                            fixed_str = fixer.fix_ragged_row(header_list, clean_row)
-                            
-                            # Add to preview list
-                            preview_data.append({
-                                "original": clean_row,
-                                "fixed": fixed_str
-                            })
+                        # Read Bad Rows. utf-8-sig: the byte-mode splitter
+                        # copies a BOM'd header line into the quarantine, and
+                        # str.strip() does not remove U+FEFF - without this the
+                        # header slips past the filter below and gets "fixed".
+                        with open(quarantine_path, 'r', encoding='utf-8-sig') as f: bad_rows = f.readlines()
                         
+                        # Filter empty lines and the header copy we wrote to quarantine
+                        rows_to_fix = [
+                            row.strip() for row in bad_rows
+                            if row.strip() and row.strip() != header_str
+                        ]
+
+                        status.update(label=f"Reasoning on {len(rows_to_fix)} rows (concurrent)...")
+
+                        # Throttle widget updates to ~50 total: each one
+                        # round-trips to the browser, which would dominate
+                        # wall-clock when most rows resolve cheaply.
+                        last_reported = 0
+                        def report_progress(done, total):
+                            nonlocal last_reported
+                            if done == total or done - last_reported >= max(1, total // 50):
+                                last_reported = done
+                                status.update(label=f"Fixed {done}/{total} distinct rows...")
+
+                        # Dispatch all rows concurrently; results keep input order
+                        fixed_rows = fixer.batch_fix(
+                            header_list, rows_to_fix, progress_cb=report_progress
+                        )
+
+                        preview_data = [
+                            {"original": original, "fixed": fixed}
+                            for original, fixed in zip(rows_to_fix, fixed_rows)
+                        ]
+
+
                         st.session_state.ai_preview_data = preview_data
                         status.update(label="Analysis Complete! Waiting for review.", state="complete")
                         st.rerun()
@@ -220,26 +395,46 @@ def main():
                     st.divider()
                     st.markdown("### ✏️ Editor Workbench")
                     
-                    # Load for editor
-                    with open(quarantine_path, 'r') as f: lines = f.readlines()
-                    grid_data = [{"raw_text": line.strip()} for line in lines if line.strip()]
-                    
+                    # Load for editor (capped; never materialize a huge quarantine)
+                    with open(quarantine_path, 'r', encoding='utf-8') as f:
+                        grid_data = [
+                            {"raw_text": line.strip()}
+                            for line in islice(f, MAX_EDIT_ROWS) if line.strip()
+                        ]
+
+                    grid_truncated = stats.get("bad", 0) > MAX_EDIT_ROWS
+                    if grid_truncated:
+                        st.warning(
+                            f"Showing the first {MAX_EDIT_ROWS:,} of {stats['bad']:,} bad rows. "
+                            "Rows beyond this cap stay in quarantine and are NOT included when you save."
+                        )
+
                     edited_df = st.data_editor(grid_data, num_rows="dynamic", use_container_width=True)
                     
                     col_save, col_cancel = st.columns([1, 4])
                     if col_save.button("Save & Merge"):
                         fixed_file = os.path.join(manager.processed_dir, "fixed_manual.csv")
-                        with open(clean_path, 'r') as f: header = f.readline().strip()
-                        
+
                         # --- FIX: ADD encoding='utf-8' HERE ALSO ---
-                        with open(fixed_file, 'w', encoding='utf-8', newline='') as f:
-                            f.write(header + "\n")
-                            for item in edited_df:
-                                f.write(item["raw_text"] + "\n")
+                        with open(fixed_file, 'w', encoding='utf-8', newline='', buffering=1 << 20) as f:
+                            writer = csv.writer(f)
+                            writer.writerow(header_list)
+                            writer.writerows(csv.reader(
+                                item["raw_text"] for item in edited_df if item["raw_text"]
+                            ))
                                 
                         engine.merge_and_finalize(clean_path, fixed_file, pq_path)
                         manager.log_event("Phase 1: Ingestion", "Manual Fix", "User manually corrected rows.")
-                        st.session_state.processing_complete = True
+                        if grid_truncated:
+                            # The quarantine is only partially handled: keep the
+                            # repair station open instead of declaring victory
+                            remaining = stats["bad"] - MAX_EDIT_ROWS
+                            manager.log_event(
+                                "Phase 1: Ingestion", "Manual Fix",
+                                f"⚠️ {remaining:,} quarantined rows beyond the editor cap were not merged."
+                            )
+                        else:
+                            st.session_state.processing_complete = True
                         st.session_state.manual_edit_mode = False
                         st.rerun()
                         
@@ -43,12 +43,12 @@ def render_history_sidebar(history_data: dict):
     # Iterate through Phases
     for phase_name, phase_data in history_data.items():
         # Determine icon based on status
-        status_icon = "🟢" if phase_data["status"] == "completed" else "🟡" if phase_data["status"] == "active" else "⚪"
-        
-        with st.sidebar.expander(f"{status_icon} {phase_name}", expanded=(phase_data["status"] == "active")):
-            if not phase_data["logs"]:
+        status_icon = "🟢" if phase_data.status == "completed" else "🟡" if phase_data.status == "active" else "⚪"
+
+        with st.sidebar.expander(f"{status_icon} {phase_name}", expanded=(phase_data.status == "active")):
+            if not phase_data.logs:
                 st.write("*No actions yet.*")
             else:
-                for log in phase_data["logs"]:
-                    st.markdown(f"`{log['time']}` **{log['category']}**")
-                    st.caption(f"{log['message']}")
\ No newline at end of file
+                for log in phase_data.logs:
+                    st.markdown(f"`{log.clock}` **{log.category}**")
+                    st.caption(f"{log.message}")
\ No newline at end of file